@@ -0,0 +1,60 @@
+# Response caches for code generation, keyed on the request text and the *schema* of the data.
+#
+# The LLM-level cache in llm_client.py keys on the full prompt, which embeds sample rows and
+# the date; this one matches a repeated analysis on same-shaped data without hashing contents.
+
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, Optional, Protocol, Sequence
+
+import pandas as pd
+from diskcache import Cache
+
+from .mypath_and_key import CACHE_PATH
+
+# Seconds a cached response stays valid.
+RESPONSE_CACHE_TTL = 24 * 3600.0
+
+
+class ResponseCache(Protocol):
+    def get(self, key: str) -> Optional[str]: ...
+
+    def set(self, key: str, value: str) -> None: ...
+
+
+class FileCache:
+    """diskcache-backed ResponseCache under CACHE_PATH with a per-entry TTL."""
+
+    def __init__(self, directory: Path = CACHE_PATH / "responses", *, ttl: Optional[float] = RESPONSE_CACHE_TTL):
+        self._cache = Cache(directory)
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self._cache.set(key, value, expire=self.ttl)
+
+
+def _schema(value: Any) -> tuple:
+    if isinstance(value, pd.DataFrame):
+        columns = sorted((str(name), str(dtype)) for name, dtype in value.dtypes.items())
+        return ("DataFrame", columns, value.shape, value.attrs)
+    if isinstance(value, pd.Series):
+        return ("Series", str(value.name), str(value.dtype), value.shape, value.attrs)
+    return (type(value).__qualname__,)
+
+
+def request_cache_key(request_text: str, user_variables: Dict[str, Any], *, context: Sequence[str] = ()) -> str:
+    """sha256 of the request text plus each variable's name, columns, dtypes, shape and attrs.
+
+    `context` holds whatever else determines the response, e.g. the model name and a hash
+    of the prompts, so switching models or editing prompts doesn't serve stale results.
+    """
+    digest = hashlib.sha256(request_text.encode("utf-8"))
+    for part in context:
+        digest.update(b"\0" + part.encode("utf-8"))
+    for name in sorted(user_variables):
+        digest.update(b"\0" + name.encode("utf-8") + b"\0")
+        digest.update(repr(_schema(user_variables[name])).encode("utf-8"))
+    return digest.hexdigest()
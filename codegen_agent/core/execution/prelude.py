@@ -2,56 +2,100 @@
 from __future__ import annotations
 import os
 import sys
-import glob
+import linecache
+import mmap
 import pickle
-
-import pandas as pd
+import struct
+import traceback
 
 os.environ.setdefault("MPLCONFIGDIR", "/tmp")
 
-VARS_DIR = "/inputs"
-CODE_PATH = "/inputs/code.py"
+# Generated code never touches the filesystem; this name labels it in tracebacks.
+CODE_PATH = "<generated-code>"
+
+# Stdin framing shared with runner.py:
+#   <n_buffers><len(code)><len(pickle)><len(buf_0)>...<code><pickle><buf_0>...
+# The code is UTF-8 and the pickle holds only the variables, so the runner can reuse one
+# serialization for several codes. Every integer is an unsigned 64-bit little-endian value.
+PAYLOAD_LENGTH_FORMAT = "<Q"
+# A buffer length with this bit set was not sent on stdin: it is in SPILL_FILE_FORMAT under
+# the job's read-only inputs dir (env JOB_INPUTS_ENV) and gets memory-mapped instead.
+SPILLED_FLAG = 1 << 63
+SPILL_FILE_FORMAT = "buf_{}.bin"
+# The pickle itself is spilled the same way (flag on its length) when it is large, e.g. object columns.
+SPILL_HEAD_FILE = "head.pkl"
+JOB_INPUTS_ENV = "CODEGEN_AGENT_JOB_INPUTS"
+
+
+def _read_exact(stream, n: int) -> bytearray:
+    # bytearray keeps the out-of-band buffers writable, so unpickled arrays are too.
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        got = stream.readinto(view[pos:])
+        if not got:
+            raise EOFError(f"payload truncated: expected {n} bytes, got {pos}")
+        pos += got
+    return buf
+
 
+def _map_spilled(name: str, n: int, access: int = mmap.ACCESS_COPY):
+    # The default copy-on-write mapping gives zero-copy reads, and arrays built on it stay writable.
+    if n == 0:
+        return bytearray()
+    with open(os.path.join(os.environ[JOB_INPUTS_ENV], name), "rb") as f:
+        return mmap.mmap(f.fileno(), n, access=access)
 
-def _load_var(path: str):
-    if pd is not None:
-        try:
-            return pd.read_pickle(path)  # type: ignore[attr-defined]
-        except Exception:
-            pass
-    with open(path, "rb") as f:
-        return pickle.load(f)
+
+def _read_payload() -> tuple[str, dict]:
+    """Read the framed code and protocol-5 variables pickle streamed on stdin."""
+    stream = sys.stdin.buffer
+    length = struct.Struct(PAYLOAD_LENGTH_FORMAT)
+    (n_buffers,) = length.unpack(_read_exact(stream, length.size))
+    code_length, *lengths = struct.unpack(f"<{n_buffers + 2}Q", _read_exact(stream, length.size * (n_buffers + 2)))
+    code = _read_exact(stream, code_length).decode("utf-8")
+    if lengths[0] & SPILLED_FLAG:
+        # pickle.loads only reads the head, so a read-only mapping avoids buffered file IO and a copy.
+        head = _map_spilled(SPILL_HEAD_FILE, lengths[0] & ~SPILLED_FLAG, mmap.ACCESS_READ)
+    else:
+        head = _read_exact(stream, lengths[0])
+    buffers = []
+    for i, n in enumerate(lengths[1:]):
+        if n & SPILLED_FLAG:
+            buffers.append(_map_spilled(SPILL_FILE_FORMAT.format(i), n & ~SPILLED_FLAG))
+        else:
+            buffers.append(_read_exact(stream, n))
+    return code, pickle.loads(head, buffers=buffers)
 
 
 def run():
-    # 1) Load variables
+    # 1) Load code and variables
+    try:
+        code, variables = _read_payload()
+    except Exception as e:
+        print(f"[prelude] Failed to load payload: {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
+
     ns = {
         "__name__": "__main__",
         "__file__": CODE_PATH,
     }
-    for p in sorted(glob.glob(os.path.join(VARS_DIR, "*.pkl"))):
-        name = os.path.splitext(os.path.basename(p))[0]
-        try:
-            ns[name] = _load_var(p)
-        except Exception as e:
-            print(f"[prelude] Failed to load {name}: {e}", file=sys.stderr, flush=True)
+    ns.update(variables)
 
-    # 2) Execute user code
-    try:
-        with open(CODE_PATH, "r", encoding="utf-8") as f:
-            code = f.read()
-    except Exception as e:
-        print(f"[prelude] Failed to read code: {e}", file=sys.stderr, flush=True)
-        sys.exit(1)
+    # Register the source so tracebacks still show the offending lines.
+    linecache.cache[CODE_PATH] = (len(code), None, code.splitlines(keepends=True), CODE_PATH)
 
+    # 2) Execute user code
     try:
         exec(compile(code, CODE_PATH, "exec"), ns, ns)
     except SystemExit as e:
         # Preserve explicit exits
         raise e
-    except Exception as e:
-        # Let the traceback go to stderr naturally
-        raise
+    except Exception:
+        # Print via the traceback module (which consults linecache) and exit like an uncaught error.
+        traceback.print_exc()
+        sys.exit(1)
 
 
 if __name__ == "__main__":
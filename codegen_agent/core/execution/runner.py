@@ -1,51 +1,259 @@
+import ast
+import atexit
+import functools
+import hashlib
+import asyncio
 import os
 import re
 import shutil
+import sys
 import tempfile
+import threading
+import uuid
+import weakref
 import pickle
+import struct
 from pathlib import Path
-from typing import Dict, Any, Set
+from typing import Dict, Any, FrozenSet, List, NamedTuple, Set
 from datetime import datetime
 
-import pandas as pd
-
 
 from ..models import ExecutionResult
 from .docker_runtime import DockerRuntime
 from .prelude import run as _PRELUDE_RUN  # only to access source file path
+from .prelude import PAYLOAD_LENGTH_FORMAT, SPILLED_FLAG, SPILL_FILE_FORMAT, SPILL_HEAD_FILE
 from ..mypath_and_key import CONTAINER_IO_PATH
 
 
+# Host-side roots: INPUTS_ROOT is mounted into the runner containers as /inputs (read-only);
+# each job's /outputs files are moved to OUTPUTS_ROOT/<job> when it ends.
+# Resolved once here so nothing on the per-execution path needs to stat path components.
+# With CODEGEN_AGENT_SHM_INPUTS=1 (Linux hosts), /inputs lives in /dev/shm, so spilled buffers
+# are written to and mmapped from memory rather than disk; they count against RAM while kept.
+if os.environ.get("CODEGEN_AGENT_SHM_INPUTS") == "1" and os.path.isdir("/dev/shm"):
+    # /dev/shm is shared by all local users: use a fresh private (0700) dir rather than a
+    # predictable name someone else could create first, and remove it at exit.
+    INPUTS_ROOT = Path(tempfile.mkdtemp(prefix="codegen-agent-inputs-", dir="/dev/shm"))
+    atexit.register(shutil.rmtree, INPUTS_ROOT, True)
+else:
+    INPUTS_ROOT = CONTAINER_IO_PATH.resolve() / "inputs"
+OUTPUTS_ROOT = CONTAINER_IO_PATH.resolve() / "outputs"
+
+DEFAULT_IMAGE = "codegen-agent-runner:py313"
+
+# One long-lived runtime (and its warm container pool) per image for the whole process.
+_RUNTIMES: Dict[str, DockerRuntime] = {}
+_RUNTIMES_LOCK = threading.Lock()
+
+
+def _get_runtime(image: str) -> DockerRuntime:
+    with _RUNTIMES_LOCK:
+        rt = _RUNTIMES.get(image)
+        if rt is None:
+            INPUTS_ROOT.mkdir(exist_ok=True)
+            OUTPUTS_ROOT.mkdir(exist_ok=True)
+            # The prelude is shared by all jobs; code and variables arrive on stdin.
+            _write_prelude_to(INPUTS_ROOT / PRELUDE_NAME)
+            rt = DockerRuntime(
+                image=image,
+                inputs_root=INPUTS_ROOT,
+                outputs_root=OUTPUTS_ROOT,
+                prelude_name=PRELUDE_NAME,
+            )
+            _RUNTIMES[image] = rt
+        return rt
+
+
+def prewarm(image: str = DEFAULT_IMAGE) -> threading.Thread:
+    """Build/verify the image and start the runner container in a background thread.
+
+    Lets a cold image build or container start overlap with LLM calls instead of
+    stalling the first execute().
+    """
+
+    def _warm() -> None:
+        try:
+            rt = _get_runtime(image)
+            rt.ensure_image()
+            rt.start()
+        except Exception as e:
+            # execute() will retry and surface the error where it matters.
+            print(f"[codegen-agent] Sandbox prewarm failed: {e}")
+
+    thread = threading.Thread(target=_warm, name="codegen-agent-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+# Our installed prelude.py, read once; copied under inputs for the container to run.
+_PRELUDE_BYTES = Path(__file__).with_name("prelude.py").read_bytes()
+# Named after its content: processes running another package version (e.g. a long-lived
+# kernel next to an upgraded script) share the inputs dir but each run their own stdin framing.
+PRELUDE_NAME = f"prelude-{hashlib.sha256(_PRELUDE_BYTES).hexdigest()[:12]}.py"
+
+
 def _write_prelude_to(path: Path) -> None:
-    # Find our installed prelude.py file content and copy under inputs
-    prelude_src = Path(__file__).with_name("prelude.py")
-    shutil.copyfile(prelude_src, path)
+    # The name fixes the content, so an existing file is already right. A new one is swapped in
+    # atomically, so a job never reads a half-written prelude.
+    if path.exists():
+        return
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}")
+    tmp.write_bytes(_PRELUDE_BYTES)
+    os.replace(tmp, path)
+
+
+# Identifier sets of recently executed code (LRU, bounded). lru_cache is thread-safe, which
+# matters because execute_async runs jobs, e.g. speculative candidates, in parallel threads.
+_IDENT_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=_IDENT_CACHE_SIZE)
+def _used_identifiers(code: str) -> FrozenSet[str]:
+    # Collect bare names only, so identifiers in strings, comments and attributes don't drag variables in.
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # Let the sandbox report the syntax error; fall back to the plain identifier scan.
+        variable_pattern = r"\b([a-zA-Z_][a-zA-Z0-9_]*)\b"
+        used: Set[str] = set(re.findall(variable_pattern, code))
+    else:
+        used = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+    return frozenset(used)
 
 
 def _find_used_variables(code: str, namespace: Dict[str, Any]) -> Dict[str, Any]:
-    # Very simple identifier scan; mirrors your earlier heuristic
-    variable_pattern = r"\b([a-zA-Z_][a-zA-Z0-9_]*)\b"
-    used: Set[str] = set(re.findall(variable_pattern, code))
-    return {k: v for k, v in namespace.items() if k in used}
+    used = _used_identifiers(code)
+    return {k: namespace[k] for k in used & namespace.keys()}
 
 
-def _save_var(path: Path, value: Any) -> None:
-    if pd is not None and hasattr(pd, "DataFrame") and isinstance(value, getattr(pd, "DataFrame")):
-        value.to_pickle(path)  # type: ignore[attr-defined]
-        return
-    # generic pickle
-    with open(path, "wb") as f:
-        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+# Out-of-band buffers at least this large are written to a file the container memory-maps,
+# instead of being pushed through the stdin pipe.
+SPILL_THRESHOLD = 64 * 1024 * 1024
+
+
+def _is_strided(np: Any, array: Any) -> bool:
+    return (
+        isinstance(array, np.ndarray)
+        and array.dtype != object
+        and not (array.flags.c_contiguous or array.flags.f_contiguous)
+    )
+
+
+def _prepare_value(value: Any) -> Any:
+    """Type-specific fast paths applied before pickling."""
+    # numpy/pandas are only consulted if already imported; without them there are no arrays to handle.
+    np = sys.modules.get("numpy")
+    if np is None:
+        return value
+    if _is_strided(np, value):
+        # numpy pickles non-contiguous arrays in-band (copied into the stream and again on load);
+        # one contiguous copy here lets the buffer go out-of-band like every other array.
+        return np.ascontiguousarray(value)
+    pd = sys.modules.get("pandas")
+    if pd is not None and isinstance(value, (pd.DataFrame, pd.Series)):
+        # Frames and series pickle their column blocks as plain ndarrays, so contiguous blocks
+        # already go out-of-band. Views such as df.iloc[::2] hold strided blocks; a copy
+        # consolidates them into contiguous ones.
+        mgr = getattr(value, "_mgr", None)
+        if mgr is not None and any(_is_strided(np, array) for array in mgr.arrays):
+            return value.copy()
+    return value
+
+
+class _SerializedVariables(NamedTuple):
+    lengths: List[int]  # the pickle's, then each buffer's; SPILLED_FLAG marks spilled ones
+    inline: List[bytes | memoryview]  # the chunks sent on stdin, in order
+    spill_dir: Path
+    spilled: List[str]  # file names under spill_dir
+
+
+def _serialize_variables(variables: Dict[str, Any], spill_dir: Path) -> _SerializedVariables:
+    """Pickle variables with protocol 5, spilling large parts under `spill_dir`.
+
+    `buffer_callback` receives contiguous numpy buffers (including DataFrame blocks)
+    instead of copying them into the pickle stream; they follow the pickle as raw frames,
+    except buffers of SPILL_THRESHOLD bytes or more, which are written under `spill_dir`
+    for the container to mmap. A pickle that large (in-band data such as object columns)
+    is spilled the same way. See prelude.py for the layout.
+    """
+    buffers: List[pickle.PickleBuffer] = []
+    variables = {name: _prepare_value(value) for name, value in variables.items()}
+    head = pickle.dumps(variables, protocol=5, buffer_callback=buffers.append)
+    lengths = []
+    inline: List[bytes | memoryview] = []
+    spilled = []
+    for name, raw in [(SPILL_HEAD_FILE, memoryview(head))] + [
+        (SPILL_FILE_FORMAT.format(i), buf.raw()) for i, buf in enumerate(buffers)
+    ]:
+        if raw.nbytes >= SPILL_THRESHOLD:
+            spill_dir.mkdir(parents=True, exist_ok=True)
+            with open(spill_dir / name, "wb") as f:
+                f.write(raw)
+            lengths.append(raw.nbytes | SPILLED_FLAG)
+            spilled.append(name)
+        else:
+            inline.append(raw)
+            lengths.append(raw.nbytes)
+    return _SerializedVariables(lengths, inline, spill_dir, spilled)
+
+
+def _frame(code: str, serialized: _SerializedVariables) -> List[bytes | memoryview]:
+    code_bytes = code.encode("utf-8")
+    lengths = [len(code_bytes), *serialized.lengths]
+    header = struct.pack(PAYLOAD_LENGTH_FORMAT, len(serialized.lengths) - 1) + struct.pack(
+        f"<{len(lengths)}Q", *lengths
+    )
+    # Returned as separate chunks so array buffers are written to the pipe without another copy.
+    return [header, code_bytes, *serialized.inline]
+
+
+def _serialize_payload(code: str, variables: Dict[str, Any], spill_dir: Path) -> List[bytes | memoryview]:
+    """Frame code and pickled variables into the chunks the prelude reads from stdin."""
+    return _frame(code, _serialize_variables(variables, spill_dir))
+
+
+class PreparedVariables:
+    """Variables whose serialization is reused by every `execute` they are passed to.
+
+    Each distinct set of variables used by the code is pickled once; spilled buffers are
+    written once under INPUTS_ROOT and hard-linked into each job's inputs dir. The values
+    are assumed unchanged: wrap a new dict (or new values) in a new instance. Spill files
+    are removed when the instance is garbage-collected.
+    """
+
+    def __init__(self, variables: Dict[str, Any]):
+        self.variables = variables
+        self._spill_root = INPUTS_ROOT / f"prepared_{uuid.uuid4().hex[:12]}"
+        self._serialized: Dict[FrozenSet[str], _SerializedVariables] = {}
+        self._lock = threading.Lock()
+        weakref.finalize(self, shutil.rmtree, self._spill_root, True)
+
+    def payload(self, code: str, job_inputs: Path) -> List[bytes | memoryview]:
+        names = frozenset(_used_identifiers(code) & self.variables.keys())
+        with self._lock:
+            serialized = self._serialized.get(names)
+            if serialized is None:
+                spill_dir = self._spill_root / str(len(self._serialized))
+                serialized = _serialize_variables({k: self.variables[k] for k in names}, spill_dir)
+                self._serialized[names] = serialized
+        if serialized.spilled:
+            job_inputs.mkdir()
+            for name in serialized.spilled:
+                try:
+                    os.link(serialized.spill_dir / name, job_inputs / name)
+                except OSError:
+                    shutil.copyfile(serialized.spill_dir / name, job_inputs / name)
+        return _frame(code, serialized)
 
 
 def _cleanup_old_runs(max_runs: int = 50) -> None:
     """Keep only the most recent max_runs execution folders."""
     run_dirs = []
-    for item in CONTAINER_IO_PATH.iterdir():
+    for item in OUTPUTS_ROOT.iterdir():
         if item.is_dir() and item.name.startswith("run_"):
             try:
                 # Extract timestamp from folder name for sorting
-                timestamp_str = item.name[4:]  # Remove "run_" prefix
+                timestamp_str = item.name[4:26]  # Remove "run_" prefix and the unique suffix
                 datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S_%f")
                 run_dirs.append(item)
             except ValueError:
@@ -61,38 +269,57 @@ def _cleanup_old_runs(max_runs: int = 50) -> None:
         shutil.rmtree(oldest, ignore_errors=True)
 
 
-def execute(code: str, variables: Dict[str, Any], *, image: str = "codegen-agent-runner:py313") -> ExecutionResult:
-    """Execute code inside a disposable Docker container with RO inputs and RW outputs.
+def execute(
+    code: str, variables: Dict[str, Any] | PreparedVariables, *, image: str = DEFAULT_IMAGE
+) -> ExecutionResult:
+    """Execute code inside a long-lived Docker container with RO inputs and RW outputs.
+
+    Code and the variables it uses are streamed to the container's stdin (very large array
+    buffers go through `/inputs/<job>` instead); each call runs in a fresh Python process with
+    an empty `/outputs` working dir, whose files are moved to OUTPUTS_ROOT/<job> afterwards.
+    Pass PreparedVariables to reuse the variables' serialization across calls.
 
     Returns ExecutionResult(stdout, stderr, returncode).
     """
     # Create timestamped run directory
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    run_root = CONTAINER_IO_PATH / f"run_{timestamp}"
-    inputs = run_root / "inputs"
-    outputs = run_root / "outputs"
+    # The random suffix keeps concurrent executions in the same microsecond apart.
+    job_id = f"run_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{uuid.uuid4().hex[:6]}"
+    rt = _get_runtime(image)
+    inputs = INPUTS_ROOT / job_id  # only created when large buffers are spilled
+    outputs = OUTPUTS_ROOT / job_id
 
     try:
-        run_root.mkdir()
-        inputs.mkdir()
         outputs.mkdir()
 
-        # Write code
-        (inputs / "code.py").write_text(code, encoding="utf-8")
-        # Write prelude
-        _write_prelude_to(inputs / "prelude.py")
-
         # Filter and serialize used variables
-        filtered = _find_used_variables(code, variables)
-        for name, val in filtered.items():
-            _save_var(inputs / f"{name}.pkl", val)
+        if isinstance(variables, PreparedVariables):
+            payload = variables.payload(code, inputs)
+        else:
+            filtered = _find_used_variables(code, variables)
+            payload = _serialize_payload(code, filtered, inputs)
 
-        # Run container
-        rt = DockerRuntime(image=image)
+        # Run in the shared container
         rt.ensure_image()
-        proc = rt.run(str(inputs), str(outputs))
+        proc = rt.run(job_id, payload)
 
-        return ExecutionResult(stdout=proc.stdout, stderr=proc.stderr, returncode=proc.returncode)
+        return ExecutionResult(
+            stdout=proc.stdout.decode("utf-8", errors="replace"),
+            stderr=proc.stderr.decode("utf-8", errors="replace"),
+            returncode=proc.returncode,
+        )
     finally:
+        # Spilled buffers can be huge; drop them as soon as the job is done.
+        shutil.rmtree(inputs, ignore_errors=True)
         # Always clean up old runs, regardless of success/failure
         _cleanup_old_runs(50)
+
+
+async def execute_async(
+    code: str, variables: Dict[str, Any] | PreparedVariables, *, image: str = DEFAULT_IMAGE
+) -> ExecutionResult:
+    """`execute` in a worker thread, so the event loop keeps serving LLM calls while the job runs."""
+    return await asyncio.to_thread(execute, code, variables, image=image)
+
+
+if os.environ.get("CODEGEN_AGENT_PRELOAD_IMAGE") == "1":
+    prewarm()
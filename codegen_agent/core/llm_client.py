@@ -1,8 +1,15 @@
 import os
+import sys
+import atexit
+import logging
+import asyncio
+import hashlib
 import datetime
+from contextvars import ContextVar
 from enum import Enum
-from typing import Sequence
+from typing import AsyncGenerator, Dict, List, Optional, Sequence, Set, Union
 
+import httpx
 from diskcache import Cache
 from autogen_ext.cache_store.diskcache import DiskCacheStore
 from autogen_ext.models.cache import ChatCompletionCache, CHAT_CACHE_VALUE_TYPE
@@ -12,11 +19,49 @@ from .mylog import get_logger
 
 from .mypath_and_key import CACHE_PATH
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # orjson is optional
+    from json import loads as _json_loads
+
 # Constants
 GOOGLE_OPENAI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/openai/"
 MAX_TOTAL_CALLS = 1000
 MAX_TOTAL_TOKENS = 1_000_000
 DEBUG = False
+# Connection pool for the provider API; keep-alive + HTTP/2 let concurrent requests share TLS sessions.
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+# Below this share of prompt tokens served from the provider's prompt cache, the prefix is likely unstable.
+MIN_CACHED_PROMPT_RATIO = 0.5
+# Providers don't cache prompts shorter than this, so those are never expected to hit.
+MIN_CACHEABLE_PROMPT_TOKENS = 1024
+
+# Provider cache accounting for the in-flight create() call, filled by the HTTP response hook.
+# autogen's CreateResult only carries prompt/completion tokens, so these are read from the raw response.
+# The dict is shared by reference with the task autogen spawns for the request.
+_CACHE_USAGE: ContextVar[Optional[Dict[str, int]]] = ContextVar("codegen_agent_cache_usage", default=None)
+
+
+async def _record_cache_usage(response: httpx.Response) -> None:
+    usage_out = _CACHE_USAGE.get()
+    # Streaming responses must not be consumed here.
+    if usage_out is None or "json" not in response.headers.get("content-type", ""):
+        return
+    await response.aread()
+    try:
+        # Decoded straight from the body bytes; orjson.JSONDecodeError is a ValueError too.
+        usage = _json_loads(response.content).get("usage") or {}
+    except ValueError:
+        return
+    details = usage.get("prompt_tokens_details") or {}
+    usage_out["prompt_tokens"] = usage.get("prompt_tokens") or 0
+    usage_out["completion_tokens"] = usage.get("completion_tokens") or 0
+    # Only providers that report prompt caching get these keys.
+    if details.get("cached_tokens") is not None:
+        usage_out["cached_tokens"] = details["cached_tokens"]
+    for key in ("cache_creation_input_tokens", "cache_read_input_tokens"):
+        if usage.get(key) is not None:
+            usage_out[key] = usage[key]
 
 
 class LLMModels(Enum):
@@ -36,6 +81,12 @@ class GeminiAPIError(Exception):
 
 
 class ModelClientFactory:
+    @staticmethod
+    def _create_http_client() -> httpx.AsyncClient:
+        # One pool per model client: pooled connections are bound to the event loop that opened
+        # them, and closing a model client closes its pool.
+        return httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, event_hooks={"response": [_record_cache_usage]})
+
     @staticmethod
     def create_client(model: LLMModels = LLMModels.GEMINI25_FLASH):
         if model in {LLMModels.GEMINI25_FLASH, LLMModels.GEMINI25_FLASH_LITE, LLMModels.GEMINI25_PRO}:
@@ -58,6 +109,7 @@ class ModelClientFactory:
             model=model.value,
             api_key=api_key,
             base_url=GOOGLE_OPENAI_BASE_URL,
+            http_client=ModelClientFactory._create_http_client(),
             temperature=0.0,
             max_tokens=100000,
             model_info=ModelInfo(
@@ -76,6 +128,7 @@ class ModelClientFactory:
         return OpenAIChatCompletionClient(
             model=model.value,
             api_key=api_key,
+            http_client=ModelClientFactory._create_http_client(),
             temperature=0.0,
             max_tokens=100000,
             model_info=ModelInfo(
@@ -85,19 +138,43 @@ class ModelClientFactory:
 
 
 class UsageTracker:
+    # Calls and tokens are counted in memory and added to the disk cache every FLUSH_EVERY calls and at exit.
+    FLUSH_EVERY = 10
+
     def __init__(self, cache_store):
         self.cache_store = cache_store
         self._calls_key = "llm_total_calls"
         self._tokens_key = "llm_total_tokens"
+        self._totals: Optional[Dict[str, int]] = None  # shared totals as of the last load/flush
+        self._deltas: Dict[str, int] = {}  # this process's counts not yet added to the cache
+        self._unflushed_calls = 0
+        atexit.register(self.flush)
+
+    def _load(self) -> Dict[str, int]:
+        if self._totals is None:
+            self._totals = {key: self.cache_store.cache.get(key, 0) for key in (self._calls_key, self._tokens_key)}
+        return self._totals
 
     def get_usage(self, key: str) -> int:
-        return self.cache_store.cache.get(key, 0)
+        return self._load().get(key, 0) + self._deltas.get(key, 0)
 
     def increment_usage(self, key: str, amount: int = 1) -> int:
-        current = self.get_usage(key)
-        new_total = current + amount
-        self.cache_store.cache.set(key, new_total)
-        return new_total
+        self._deltas[key] = self._deltas.get(key, 0) + amount
+        return self.get_usage(key)
+
+    def flush(self):
+        """Add this process's unflushed counts to the cache store.
+
+        Deltas are added atomically with `incr`, so processes sharing the cache (e.g. a
+        notebook and a script) don't overwrite each other's counts.
+        """
+        if not self._deltas:
+            return
+        totals = self._load()
+        deltas, self._deltas = self._deltas, {}
+        for key, delta in deltas.items():
+            totals[key] = self.cache_store.cache.incr(key, delta, default=0)
+        self._unflushed_calls = 0
 
     def check_limits(self):
         if self.get_usage(self._calls_key) >= MAX_TOTAL_CALLS:
@@ -114,33 +191,51 @@ class UsageTracker:
             total_token = result.usage.prompt_tokens + result.usage.completion_tokens * 4
             self.increment_usage(self._calls_key, 1)
             self.increment_usage(self._tokens_key, total_token)
+            self._unflushed_calls += 1
+            if self._unflushed_calls >= self.FLUSH_EVERY:
+                self.flush()
             return total_token
         return 0
 
     def get_stats(self) -> dict:
+        tokens = self.get_usage(self._tokens_key)
         return {
             "from": self.cache_store.cache.get("llm_usage_from", "unknown"),
-            "calls": self.cache_store.cache.get("llm_total_calls", 0),
-            "tokens": self.cache_store.cache.get("llm_total_tokens", 0),
-            "cost_in_usd": self.cache_store.cache.get("llm_total_tokens", 0) / 1_000_000 * 0.1,
+            "calls": self.get_usage(self._calls_key),
+            "tokens": tokens,
+            "cost_in_usd": tokens / 1_000_000 * 0.1,
             "max_calls": MAX_TOTAL_CALLS,
             "max_tokens": MAX_TOTAL_TOKENS,
         }
 
     def reset_usage(self):
         self.cache_store.cache.set("llm_usage_from", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        self.cache_store.cache.set("llm_total_calls", 0)
-        self.cache_store.cache.set("llm_total_tokens", 0)
+        self._totals = {self._calls_key: 0, self._tokens_key: 0}
+        self._deltas = {}
+        self._unflushed_calls = 0
+        for key in self._totals:
+            self.cache_store.cache.set(key, 0)
 
 
 # global cache store for chat completions
 cache_store = DiskCacheStore[CHAT_CACHE_VALUE_TYPE](Cache(CACHE_PATH))
+# shared by all clients so the in-memory totals stay consistent within the process
+usage_tracker = UsageTracker(cache_store)
+
+
+def _format_message(msg: LLMMessage) -> str:
+    if hasattr(msg, "content") and hasattr(msg, "source"):
+        return f"{msg.source}: {msg.content}"  # type: ignore
+    return f"{msg.content}"
 
 
 class FullLogChatClientCache(ChatCompletionCache):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, model_name: str = "", **kwargs):
         super().__init__(*args, **kwargs)
-        self.usage_tracker = UsageTracker(cache_store)
+        # Identifies the underlying model, e.g. for keying caches of its responses.
+        self.model_name = model_name
+        self.usage_tracker = usage_tracker
+        self._seen_prefixes: Set[bytes] = set()  # prefixes of uncached calls made so far
 
     async def create(self, messages: Sequence[LLMMessage], *args, **kwargs) -> CreateResult:
         # Check usage limits
@@ -148,13 +243,9 @@ class FullLogChatClientCache(ChatCompletionCache):
 
         # Setup logging
         logger = get_logger()
-        logger.info(f"========{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}========")
-        req = []
-        for msg in messages:
-            if hasattr(msg, "content") and hasattr(msg, "source"):
-                req.append(f"{msg.source}: {msg.content}")  # type: ignore
-            else:
-                req.append(f"{msg.content}")
+        log_info = logger.isEnabledFor(logging.INFO)
+        if log_info:
+            logger.info(f"========{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}========")
 
         # Log request if in DEBUG mode
         if DEBUG:
@@ -164,27 +255,94 @@ class FullLogChatClientCache(ChatCompletionCache):
             logger.info("**************************************************")
 
         # CORE LOGIC: Make the actual LLM call
+        cache_usage: Dict[str, int] = {}
+        token = _CACHE_USAGE.set(cache_usage)
         try:
             result = await super().create(messages, *args, **kwargs)
         except Exception as e:
             logger.error(f"Error during LLM request: {e}")
-            if not DEBUG:
-                logger.info("*********************Full Request********************* \n" + "\n".join(req))
+            if not DEBUG and log_info:
+                # The full request is only formatted when it is actually dumped.
+                req = "\n".join(_format_message(msg) for msg in messages)
+                logger.info("*********************Full Request********************* \n" + req)
             raise e from None
+        finally:
+            _CACHE_USAGE.reset(token)
+        if not result.cached:
+            self._log_cache_usage(logger, messages, cache_usage)
 
         # Update usage tracking
         total_tokens = self.usage_tracker.update_usage_from_result(result)
-        if total_tokens > 0:
+        if total_tokens > 0 and log_info:
             logger.info(f"Usage: {total_tokens}/{MAX_TOTAL_TOKENS} tokens")
 
         # Log the request and response
-        logger.info("Request: \n" + req[-1])
-        logger.info("------")
-        logger.info("Response: ")
-        logger.info(result.content)
+        if log_info:
+            logger.info("Request: \n" + _format_message(messages[-1]))
+            logger.info("------")
+            logger.info("Response: ")
+            logger.info(result.content)
 
         return result
 
+    async def create_stream(
+        self, messages: Sequence[LLMMessage], *args, **kwargs
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        """Like `create`, but yields text chunks as they arrive and then the final CreateResult."""
+        self.usage_tracker.check_limits()
+        logger = get_logger()
+        # Without it, streamed results report zero usage and would bypass the token limit.
+        extra_create_args = dict(kwargs.pop("extra_create_args", None) or {})
+        extra_create_args.setdefault("stream_options", {"include_usage": True})
+
+        result: Optional[CreateResult] = None
+        try:
+            async for chunk in super().create_stream(messages, *args, extra_create_args=extra_create_args, **kwargs):
+                if isinstance(chunk, CreateResult):
+                    result = chunk
+                yield chunk
+        except Exception as e:
+            logger.error(f"Error during LLM request: {e}")
+            raise e from None
+        if result is None:
+            return
+
+        total_tokens = self.usage_tracker.update_usage_from_result(result)
+        if logger.isEnabledFor(logging.INFO):
+            if total_tokens > 0:
+                logger.info(f"Usage: {total_tokens}/{MAX_TOTAL_TOKENS} tokens")
+            logger.info("Request: \n" + _format_message(messages[-1]))
+            logger.info("------")
+            logger.info("Response (streamed): ")
+            logger.info(result.content)
+
+    def _log_cache_usage(
+        self, logger: logging.Logger, messages: Sequence[LLMMessage], cache_usage: Dict[str, int]
+    ) -> None:
+        # Only a call whose stable prefix (system prompt + data context) was already sent can hit the cache.
+        prefix = hashlib.sha256("\0".join(str(msg.content) for msg in messages[:2]).encode("utf-8")).digest()
+        seen = prefix in self._seen_prefixes
+        self._seen_prefixes.add(prefix)
+        if not cache_usage:
+            return
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Cache usage: %s", cache_usage)
+        prompt_tokens = cache_usage.get("prompt_tokens", 0)
+        cached_tokens = cache_usage.get("cached_tokens")
+        # Prompts below the provider's minimum cacheable size always report 0 cached tokens.
+        if seen and cached_tokens is not None and prompt_tokens >= MIN_CACHEABLE_PROMPT_TOKENS:
+            ratio = cached_tokens / prompt_tokens
+            if ratio < MIN_CACHED_PROMPT_RATIO:
+                logger.warning(
+                    "Only %.0f%% of %d prompt tokens were served from the prompt cache; the prompt prefix may not be stable.",
+                    ratio * 100,
+                    prompt_tokens,
+                )
+
+    async def create_many(self, batches: List[Sequence[LLMMessage]], *args, **kwargs) -> List[CreateResult]:
+        """Issue independent requests concurrently; each one still goes through `create` (cache, limits, logs)."""
+        return list(await asyncio.gather(*(self.create(messages, *args, **kwargs) for messages in batches)))
+
     def get_usage_stats(self) -> dict:
         return self.usage_tracker.get_stats()
 
@@ -195,7 +353,7 @@ class FullLogChatClientCache(ChatCompletionCache):
 def create_client(*args, model: LLMModels = LLMModels.GEMINI25_FLASH, **kwargs) -> FullLogChatClientCache:
     """Returns a FullLogChatClientCache instance with the configured model client and cache store."""
     model_client = ModelClientFactory.create_client(model)
-    return FullLogChatClientCache(*args, client=model_client, store=cache_store, **kwargs)
+    return FullLogChatClientCache(*args, client=model_client, store=cache_store, model_name=model.value, **kwargs)
 
 
 async def sample():
@@ -209,10 +367,11 @@ async def sample():
 
 
 def main():
-    import asyncio
-    import nest_asyncio
+    # nest_asyncio slows every await; it is only needed when a loop is already running (IPython/Jupyter).
+    if "ipykernel" in sys.modules or "IPython" in sys.modules:
+        import nest_asyncio
 
-    nest_asyncio.apply()
+        nest_asyncio.apply()
     asyncio.run(sample())
 
 
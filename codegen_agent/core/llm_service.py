@@ -12,21 +12,34 @@ Notes on prompt strings:
   are preserved exactly as written.
 """
 
-import json
-from datetime import datetime
-from typing import Dict, Any, List, Optional, Protocol, Type
-from autogen_core.models import UserMessage, SystemMessage, AssistantMessage
+import functools
+import hashlib
+from datetime import date
+import weakref
+from typing import Callable, Dict, Any, List, Optional, Protocol, Sequence, Tuple, Type, TypeVar
+from autogen_core.models import UserMessage, SystemMessage, AssistantMessage, LLMMessage
+from pydantic import BaseModel
 
 import pandas as pd
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # orjson is optional
+    from json import loads as _json_loads
+
 from .models import (
     CodeGenerationRequest,
     CodeGenerationResult,
     ExecutionResult,
     CodeAssessmentResult,
+    BatchAssessmentResult,
     ExecutionAssessmentHistoryItem,
+    clip_text,
 )
 from .llm_client import FullLogChatClientCache
+from .cache import ResponseCache, request_cache_key
+
+ResultT = TypeVar("ResultT", bound=BaseModel)
 # -----------------------------
 # Prompt templates (raw strings)
 # -----------------------------
@@ -56,6 +69,25 @@ You are an expert-level code assessment agent. Your purpose is to meticulously a
 * **Follow a Strict Schema:** Your entire output must be a single JSON object that strictly conforms to the provided `CodeAssessmentResult` schema. Do not output any other text or explanation outside of this JSON structure.
 """
 
+# System prompt for two-stage assessment: the same role without the JSON-only directive, so the
+# first call can reason in prose. The extraction turn asks for JSON and the schema enforces it.
+OUTPUT_ASSESMENT_REASONING_SYSTEM_PROMPT = """
+You are an expert-level code assessment agent. Your purpose is to meticulously analyze the results of executed Python code to determine if it successfully fulfilled the original user's request.
+
+## **Core Directives**
+* **Be a Critical Analyst:** Your primary role is to be a critic, not a simple code generator. Scrutinize the execution output for subtle logical errors or failures to meet the user's full intent.
+* **History Matters:** Refer to the provided conversation history to ensure your suggestions are novel and not repeating previous failed attempts.
+* **Reason Before Concluding:** Work through the evidence step by step before deciding whether the request was fulfilled.
+"""
+
+# Providers cache prompts by *prefix*, so the invariant data context is sent as its own
+# message right after the system prompt, and everything that varies per call (request,
+# code, stdout/stderr) goes in the prompt that follows it, with the date at its very end.
+DATA_CONTEXT_PROMPT_TEMPLATE = """
+**Available Data:**
+{data_description}
+"""
+
 OUTPUT_ASSESSMENT_PROMPT_TEMPLATE = """
 Your task is to assess the result of a code execution against the original user request and conversation history. Based on your assessment, you will determine if the request was fulfilled and, if not, generate a plan and new code for the next attempt.
 
@@ -77,30 +109,26 @@ Your task is to assess the result of a code execution against the original user
 {stderr}
 ```
 
-**Available Data:**
-{data_description}
-
-  * **Current date** :{today}.
-
 
 ## **Your Task**
 
-Analyze the execution artifacts in the context of the user request and history. If the user request was not fulfilled, generate a plan and new code for the next attempt.
+Analyze the execution artifacts in the context of the user request, the available data and history. If the user request was not fulfilled, generate a plan and new code for the next attempt.
+
+  * **Current date** :{today}.
 """
 
 CODE_GENERATION_PROMPT_TEMPLATE = """
-**User Request:** "Today is {today}. {request_text}"
+**User Request:** "{request_text}"
 
-**Available Data:**
-{data_description}
+Generate the Python code to fulfill the request using the available data.
 
-Generate the Python code to fulfill the request.
+Today is {today}.
 """
 
 CODE_REGENERATION_PROMPT_TEMPLATE = """
 Your previous code attempt failed. Analyze the error and generate a new version of the code.
 
-# **User Request:** "Today is {today}. {request_text}"
+# **User Request:** "{request_text}"
 
 # **Your Previous Code:**
 ```python
@@ -117,50 +145,245 @@ Your previous code attempt failed. Analyze the error and generate a new version
 {stderr}
 ```
 
-**Available Data:**
-{data_description}
-
 **Your Task:**
 Follow your debugging protocol precisely to generate the corrected, complete Python code.
+
+Today is {today}.
+"""
+
+BATCH_ASSESSMENT_PROMPT_TEMPLATE = """
+Your task is to assess several independent attempts at the same user request and pick the best one. Based on your assessment, you will determine if the best attempt fulfilled the request and, if not, generate a plan and new code for the next attempt.
+
+## **Context**
+* **User Request:** "{request_text}"
+
+## **Candidates**
+{candidates}
+
+
+## **Your Task**
+
+Compare the candidates in the context of the user request, the available data and history. Set `best_index` to the number of the best candidate, and fill the remaining fields for that candidate. If it did not fulfill the request, generate a plan and new code for the next attempt.
+
+  * **Current date** :{today}.
+"""
+
+BATCH_CANDIDATE_TEMPLATE = """<candidate {index}>
+```python
+{code}
+```
+
+  * **Return code:** {returncode}
+
+  * **Execution Result (stdout):**
+```
+{stdout}
+```
+
+  * **Execution Result (stderr):**
+```
+{stderr}
+```
+</candidate {index}>"""
+
+# Two-stage assessment: the reasoning call runs without a schema, then a short
+# follow-up turn converts that analysis into the structured verdict.
+ASSESSMENT_REASONING_SUFFIX = """
+Think it through in plain prose for now, including any corrected code in full. Do not output JSON yet.
 """
 
+ASSESSMENT_EXTRACTION_PROMPT = """
+Convert your analysis above into a single `CodeAssessmentResult` JSON object. Copy any corrected code verbatim into `code`; do not change your conclusions.
+"""
+
+# Hash of everything prompt-side that shapes a code generation response.
+_CODE_GENERATION_PROMPTS = (CODE_GENERATOR_SYSTEM_PROMPT, DATA_CONTEXT_PROMPT_TEMPLATE, CODE_GENERATION_PROMPT_TEMPLATE)
+CODE_GENERATION_PROMPT_HASH = hashlib.sha256("\0".join(_CODE_GENERATION_PROMPTS).encode("utf-8")).hexdigest()[:16]
+
 # -----------------------------
 # LLM client protocol
 # -----------------------------
 
 
+def _today() -> str:
+    return date.today().isoformat()
+
+
+def _escape_braces(value: str) -> str:
+    return value.replace("{", "{{").replace("}", "}}")
+
+
+# Templates are partially evaluated: the values fixed for a workflow (date, request text) are
+# substituted once, and each call only formats its own fields into the much shorter remainder.
+@functools.lru_cache(maxsize=64)
+def _bind_template(template: str, today: str, request_text: str) -> str:
+    # Bound values get their braces doubled, so the later .format() restores them verbatim.
+    return template.replace("{today}", _escape_braces(today)).replace("{request_text}", _escape_braces(request_text))
+
+
+@functools.lru_cache(maxsize=32)
+def _data_context(data_description: str) -> str:
+    # Keyed on the cached description string, whose hash Python keeps, so repeat calls are O(1).
+    return DATA_CONTEXT_PROMPT_TEMPLATE.format(data_description=data_description)
+
+
+# (head, tail) characters of execution output kept in assessment prompts. stdout matters
+# most at the start, a traceback at the end.
+STDOUT_CLIP = (2048, 512)
+STDERR_CLIP = (512, 2048)
+
+
+# (id(value), name) -> (fingerprint, description). Entries are dropped when the value is
+# garbage collected, so a recycled id() can never hit a stale description.
+_VARIABLE_DESCRIPTIONS: Dict[Tuple[int, str], Tuple[tuple, str]] = {}
+
+
+@functools.singledispatch
+def _fingerprint(value: Any) -> Optional[tuple]:
+    # Only dataframes and series are described; anything else is left out of the prompt.
+    return None
+
+
+def _sample_hash(sample: pd.DataFrame | pd.Series) -> tuple:
+    # The description shows the first rows, so in-place edits such as df["price"] *= 100
+    # must change the fingerprint; hashing those rows only stays cheap for any frame size.
+    try:
+        return tuple(pd.util.hash_pandas_object(sample).tolist())
+    except TypeError:
+        return (object(),)  # unhashable cells (e.g. lists): never matches, so always re-describe
+
+
+@_fingerprint.register
+def _(value: pd.DataFrame) -> Optional[tuple]:
+    # Cheap mutation check: metadata plus a hash of the sample rows.
+    bounds = (value.index[0], value.index[-1]) if len(value) else ()
+    sample = _sample_hash(value.head(3))
+    return (value.shape, tuple(value.columns), tuple(value.dtypes), bounds, repr(value.attrs), sample)
+
+
+@_fingerprint.register
+def _(value: pd.Series) -> Optional[tuple]:
+    bounds = (value.index[0], value.index[-1]) if len(value) else ()
+    return (value.shape, value.name, value.dtype, bounds, _sample_hash(value.head(3)))
+
+
+def _cached_variable_description(var_name: str, var_value: Any) -> Optional[str]:
+    fingerprint = _fingerprint(var_value)
+    if fingerprint is None:
+        return None
+    key = (id(var_value), var_name)
+    cached = _VARIABLE_DESCRIPTIONS.get(key)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    description = _describe_variable(var_value, var_name)
+    if cached is None:
+        weakref.finalize(var_value, _VARIABLE_DESCRIPTIONS.pop, key, None)
+    _VARIABLE_DESCRIPTIONS[key] = (fingerprint, description)
+    return description
+
+
+@functools.singledispatch
+def _describe_variable(var_value: Any, var_name: str) -> str:
+    raise TypeError(f"Variable '{var_name}' is not a DataFrame or Series: {type(var_value).__name__}")
+
+
+@_describe_variable.register
+def _(var_value: pd.DataFrame, var_name: str) -> str:
+    return (
+        f"Variable: {var_name}\n"
+        f"Type: DataFrame\n"
+        f"Shape: {var_value.shape}\n"
+        f"Columns: {list(var_value.columns)}\n"
+        f"Dataframe Description: {var_value.attrs}\n"
+        # max_cols bounds the formatting cost of very wide frames.
+        f"Sample data (first 3 rows):\n{var_value.head(3).to_string(max_cols=20)}\n"
+    )
+
+
+@_describe_variable.register
+def _(var_value: pd.Series, var_name: str) -> str:
+    return (
+        f"Variable: {var_name}\n"
+        f"Type: Series\n"
+        f"Length: {len(var_value)}\n"
+        f"Name: {var_value.name}\n"
+        f"Sample data (first 3 values):\n{var_value.head(3).to_string()}\n"
+    )
+
+
 class LLMServiceBase:
     """Base class for LLM services, providing a client and data description utility."""
 
     def __init__(self, client: FullLogChatClientCache):
         self.client = client
 
-    def prepare_data_description(self, user_variables: Dict[str, Any]) -> str:
+    def prepare_data_description(self, request: CodeGenerationRequest) -> str:
+        """Describe the request's dataframes/series for the prompt, computed once per request.
+
+        user_variables don't change across the retries of a workflow, so the description is
+        cached on the request and shared by every service call that uses it.
+        """
+        if request._data_description is None:
+            request._data_description = self._describe_variables(request.user_variables)
+        return request._data_description
+
+    @staticmethod
+    def _create_kwargs(temperature: Optional[float]) -> Dict[str, Any]:
+        # Only pass extra_create_args when needed, so minimal clients (e.g. test doubles) keep working.
+        if temperature is None:
+            return {}
+        return {"extra_create_args": {"temperature": temperature}}
+
+    def _trusts_structured_output(self) -> bool:
+        # With native structured output the provider decodes against the json_output schema,
+        # so the response is already valid and need not be validated again.
+        model_info = getattr(self.client, "model_info", None)
+        return bool(model_info and model_info.get("structured_output"))
+
+    async def _create_structured(
+        self,
+        messages: List[LLMMessage],
+        result_type: Type[ResultT],
+        *,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        **kwargs: Any,
+    ) -> ResultT:
+        """Request a `result_type` JSON object and parse it, skipping pydantic validation when the provider enforced the schema.
+
+        With `on_chunk`, the response is streamed and each text chunk is passed to it as it arrives.
+        """
+        if on_chunk is None:
+            response = await self.client.create(messages=messages, json_output=result_type, **kwargs)
+        else:
+            response = None
+            async for chunk in self.client.create_stream(messages=messages, json_output=result_type, **kwargs):
+                if isinstance(chunk, str):
+                    on_chunk(chunk)
+                else:
+                    response = chunk
+            if response is None:
+                raise RuntimeError("LLM stream ended without a final result")
+        # Clients that already hold the decoded object (e.g. test doubles) may return it as `parsed`.
+        parsed = getattr(response, "parsed", None)
+        if parsed is not None:
+            return result_type.model_validate(parsed)
+        if self._trusts_structured_output():
+            return result_type.model_construct(**_json_loads(response.content))  # type: ignore[attr-defined]
+        # pydantic parses and validates straight from the JSON text, without an intermediate dict.
+        return result_type.model_validate_json(response.content)  # type: ignore[attr-defined]
+
+    def data_context_message(self, request: CodeGenerationRequest) -> UserMessage:
+        """The invariant data context, sent ahead of the per-call prompt so it forms a cacheable prefix."""
+        return UserMessage(content=_data_context(self.prepare_data_description(request)), source="user")
+
+    def _describe_variables(self, user_variables: Dict[str, Any]) -> str:
         """Create descriptions of available dataframes/series for the prompt."""
         descriptions: List[str] = []
         for var_name, var_value in user_variables.items():
-            try:
-                if isinstance(var_value, pd.DataFrame):
-                    description = (
-                        f"Variable: {var_name}\n"
-                        f"Type: DataFrame\n"
-                        f"Shape: {var_value.shape}\n"
-                        f"Columns: {list(var_value.columns)}\n"
-                        f"Dataframe Description: {var_value.attrs}\n"
-                        f"Sample data (first 3 rows):\n{var_value.head(3)}\n"
-                    )
-                    descriptions.append(description)
-                elif isinstance(var_value, pd.Series):
-                    description = (
-                        f"Variable: {var_name}\n"
-                        f"Type: Series\n"
-                        f"Length: {len(var_value)}\n"
-                        f"Name: {var_value.name}\n"
-                        f"Sample data (first 3 values):\n{var_value.head(3)}\n"
-                    )
-                    descriptions.append(description)
-            except Exception as e:
-                raise RuntimeError(f"Variable '{var_name}' is not a DataFrame or Series: {str(e)}") from None
+            description = _cached_variable_description(var_name, var_value)
+            if description is not None:
+                descriptions.append(description)
         if not descriptions:
             return "No data variables available."
         return "\n\n".join(descriptions)
@@ -169,57 +392,107 @@ class LLMServiceBase:
 class CodeGenerationService(LLMServiceBase):
     """Service for initial code generation."""
 
-    async def generate_code(self, request: CodeGenerationRequest) -> CodeGenerationResult:
-        """Generates Python code based on a user query."""
-        data_description = self.prepare_data_description(request.user_variables)
-        prompt = CODE_GENERATION_PROMPT_TEMPLATE.format(
-            today=datetime.today().date(),
-            request_text=request.request_text,
-            data_description=data_description,
-        )
-        response = await self.client.create(
-            messages=[
-                SystemMessage(content=CODE_GENERATOR_SYSTEM_PROMPT),
-                UserMessage(content=prompt, source="user"),
-            ],
-            json_output=CodeGenerationResult,
+    def __init__(self, client: FullLogChatClientCache, *, response_cache: Optional[ResponseCache] = None):
+        super().__init__(client)
+        # Optional cache of results keyed on request text + data schema; consulted only for deterministic calls.
+        self.response_cache = response_cache
+
+    async def generate_code(
+        self,
+        request: CodeGenerationRequest,
+        *,
+        temperature: Optional[float] = None,
+        today: Optional[str] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        failed_attempts: Sequence[str] = (),
+    ) -> CodeGenerationResult:
+        """Generates Python code based on a user query.
+
+        `temperature` overrides the client's default, e.g. to sample varied candidates.
+        Only calls at the default or zero temperature use the response cache.
+        `today` (ISO date) defaults to the current date.
+        `on_chunk` streams the response, receiving the raw JSON text as it is generated.
+        `failed_attempts` are earlier codes that did not work; the model is asked for a different one.
+        """
+        cache_key: Optional[str] = None
+        if self.response_cache is not None and not temperature and not failed_attempts:
+            # Model and prompt version are part of the key: either changes what a fresh call would return.
+            context = (getattr(self.client, "model_name", ""), CODE_GENERATION_PROMPT_HASH)
+            cache_key = request_cache_key(request.request_text, request.user_variables, context=context)
+            if (cached := self.response_cache.get(cache_key)) is not None:
+                return CodeGenerationResult.model_validate_json(cached)
+
+        prompt = _bind_template(CODE_GENERATION_PROMPT_TEMPLATE, today or _today(), request.request_text).format()
+        messages: List[LLMMessage] = [
+            SystemMessage(content=CODE_GENERATOR_SYSTEM_PROMPT),
+            self.data_context_message(request),
+            UserMessage(content=prompt, source="user"),
+        ]
+        if failed_attempts:
+            attempts = "\n\n".join(f"```python\n{code}\n```" for code in failed_attempts)
+            messages.append(
+                UserMessage(
+                    content=f"These earlier attempts did not work. Write a different solution.\n\n{attempts}",
+                    source="user",
+                )
+            )
+        result = await self._create_structured(
+            messages,
+            CodeGenerationResult,
+            on_chunk=on_chunk,
+            **self._create_kwargs(temperature),
         )
-        # Expecting a JSON-stringifiable payload in response.content
-        args = json.loads(response.content)  # type: ignore[attr-defined]
-        return CodeGenerationResult(**args)
+        if cache_key is not None:
+            self.response_cache.set(cache_key, result.model_dump_json())  # type: ignore[union-attr]
+        return result
 
 
 class AssessmentService(LLMServiceBase):
     """Service for assessing code execution results."""
 
+    def __init__(
+        self,
+        client: FullLogChatClientCache,
+        *,
+        two_stage: bool = False,
+        stdout_clip: Tuple[int, int] = STDOUT_CLIP,
+        stderr_clip: Tuple[int, int] = STDERR_CLIP,
+    ):
+        super().__init__(client)
+        # Reason without schema constraints first, then extract the verdict in a second, short call.
+        self.two_stage = two_stage
+        # Output is clipped before it enters a prompt; the UI still shows the full result.
+        self.stdout_clip = stdout_clip
+        self.stderr_clip = stderr_clip
+
     async def assess_code_output(
         self,
         request: CodeGenerationRequest,
         execution_result: ExecutionResult,
         code: str,
         previous_actions: List[ExecutionAssessmentHistoryItem],
+        *,
+        today: Optional[str] = None,
     ) -> CodeAssessmentResult:
         """Analyzes execution results to determine success and next steps."""
-        data_description = self.prepare_data_description(request.user_variables)
-
         if execution_result.success:
             template = OUTPUT_ASSESSMENT_PROMPT_TEMPLATE
-            system_prompt = OUTPUT_ASSESMENT_SYSTEM_PROMPT
+            # Both stages share this system prompt, so the extraction call still reuses the cached prefix.
+            system_prompt = OUTPUT_ASSESMENT_REASONING_SYSTEM_PROMPT if self.two_stage else OUTPUT_ASSESMENT_SYSTEM_PROMPT
         else:
             template = CODE_REGENERATION_PROMPT_TEMPLATE
             system_prompt = CODE_GENERATOR_SYSTEM_PROMPT
 
-        prompt = template.format(
-            today=datetime.today().date(),
-            request_text=request.request_text,
+        prompt = _bind_template(template, today or _today(), request.request_text).format(
             code=code,
-            stdout=execution_result.stdout,
-            stderr=execution_result.stderr,
-            data_description=data_description,
+            stdout=clip_text(execution_result.stdout, self.stdout_clip),
+            stderr=clip_text(execution_result.stderr, self.stderr_clip),
         )
 
+        # Static prefix first (system prompt, data context, append-only history), volatile prompt last.
         messages = [
             SystemMessage(content=system_prompt),
+            self.data_context_message(request),
         ]
         messages += [item.generate_agent_message() for item in previous_actions]
 
@@ -239,9 +512,50 @@ class AssessmentService(LLMServiceBase):
 
         # messages.append({"role": "user", "content": prompt})
 
-        response = await self.client.create(
-            messages=messages,
-            json_output=CodeAssessmentResult,
+        if not self.two_stage:
+            return await self._create_structured(messages, CodeAssessmentResult)
+
+        messages[-1] = UserMessage(content=prompt + ASSESSMENT_REASONING_SUFFIX, source="user")
+        reasoning = await self.client.create(messages=messages)
+        messages += [
+            AssistantMessage(content=reasoning.content, source="assessor"),  # type: ignore[arg-type]
+            UserMessage(content=ASSESSMENT_EXTRACTION_PROMPT, source="user"),
+        ]
+        return await self._create_structured(messages, CodeAssessmentResult)
+
+    async def assess_batch(
+        self,
+        request: CodeGenerationRequest,
+        execution_results: List[ExecutionResult],
+        codes: List[str],
+        previous_actions: List[ExecutionAssessmentHistoryItem],
+        *,
+        today: Optional[str] = None,
+    ) -> BatchAssessmentResult:
+        """Assesses several candidates in one call and returns the verdict for the best one."""
+        candidates = "\n\n".join(
+            BATCH_CANDIDATE_TEMPLATE.format(
+                index=i,
+                code=code,
+                returncode=result.returncode,
+                stdout=clip_text(result.stdout, self.stdout_clip),
+                stderr=clip_text(result.stderr, self.stderr_clip),
+            )
+            for i, (code, result) in enumerate(zip(codes, execution_results))
+        )
+        prompt = _bind_template(BATCH_ASSESSMENT_PROMPT_TEMPLATE, today or _today(), request.request_text).format(
+            candidates=candidates
         )
-        args = json.loads(response.content)  # type: ignore[attr-defined]
-        return CodeAssessmentResult(**args)
+
+        # Same system prompt and data context as assess_code_output, so the prefix is shared in the provider cache.
+        messages = [
+            SystemMessage(content=OUTPUT_ASSESMENT_SYSTEM_PROMPT),
+            self.data_context_message(request),
+        ]
+        messages += [item.generate_agent_message() for item in previous_actions]
+        messages += [UserMessage(content=prompt, source="user")]
+
+        result = await self._create_structured(messages, BatchAssessmentResult)
+        # Guard against an out-of-range pick rather than failing the whole attempt.
+        result.best_index = min(max(result.best_index, 0), len(codes) - 1)
+        return result
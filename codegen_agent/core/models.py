@@ -1,20 +1,64 @@
 from __future__ import annotations
-from typing import Dict, List, Optional, Any
-from pydantic import BaseModel, Field
+import copy
+from functools import cached_property
+from typing import Dict, List, Optional, Any, Tuple
+from pydantic import BaseModel, Field, PrivateAttr
+from pydantic.json_schema import DEFAULT_REF_TEMPLATE, GenerateJsonSchema
 
 from autogen_core.models import AssistantMessage
 
 
+def clip_text(text: str, clip: Tuple[int, int]) -> str:
+    """Keep `clip = (head, tail)` characters of `text` around an omission marker."""
+    head, tail = clip
+    if len(text) <= head + tail:
+        return text
+    omitted = len(text) - head - tail
+    return f"{text[:head]}\n... [{omitted} characters omitted] ...\n{text[len(text) - tail:]}"
+
+
+# (model class, by_alias, ref_template, schema_generator, mode) -> generated JSON schema.
+_JSON_SCHEMAS: Dict[tuple, Dict[str, Any]] = {}
+
+
+class StructuredOutputModel(BaseModel):
+    """Base for models requested as structured LLM output.
+
+    The JSON schema is sent (and hashed for the response cache) on every LLM call; pydantic
+    regenerates it each time, so it is built once per class here and handed out as a copy,
+    since callers such as the OpenAI strict-schema helper modify it in place.
+    """
+
+    @classmethod
+    def model_json_schema(
+        cls,
+        by_alias: bool = True,
+        ref_template: str = DEFAULT_REF_TEMPLATE,
+        schema_generator: type[GenerateJsonSchema] = GenerateJsonSchema,
+        mode: Any = "validation",
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        if kwargs:  # options from newer pydantic versions are not part of the cache key
+            return super().model_json_schema(by_alias, ref_template, schema_generator, mode, **kwargs)
+        key = (cls, by_alias, ref_template, schema_generator, mode)
+        schema = _JSON_SCHEMAS.get(key)
+        if schema is None:
+            schema = _JSON_SCHEMAS[key] = super().model_json_schema(by_alias, ref_template, schema_generator, mode)
+        return copy.deepcopy(schema)
+
+
 class CodeGenerationRequest(BaseModel):
     request_text: str
     user_variables: Dict[str, Any] = {}
+    # Prompt description of user_variables, filled on first use by LLMServiceBase.prepare_data_description.
+    _data_description: Optional[str] = PrivateAttr(default=None)
 
     @classmethod
     def empty_request(cls):
         return cls(request_text="", user_variables={})
 
 
-class CodeGenerationResult(BaseModel):
+class CodeGenerationResult(StructuredOutputModel):
     code: str
 
     @classmethod
@@ -35,8 +79,16 @@ class ExecutionResult(BaseModel):
     def empty_result(cls) -> "ExecutionResult":
         return cls(stdout="", stderr="", returncode=0)
 
+    def clipped(self, stdout_clip: Tuple[int, int], stderr_clip: Tuple[int, int]) -> "ExecutionResult":
+        """A copy with stdout/stderr cut to (head, tail) characters; self if nothing needs cutting."""
+        stdout = clip_text(self.stdout, stdout_clip)
+        stderr = clip_text(self.stderr, stderr_clip)
+        if stdout is self.stdout and stderr is self.stderr:
+            return self
+        return ExecutionResult(stdout=stdout, stderr=stderr, returncode=self.returncode)
 
-class CodeAssessmentResult(BaseModel):
+
+class CodeAssessmentResult(StructuredOutputModel):
     analysis: str = Field(...)
     success: bool = Field(...)
     should_retry: bool = Field(...)
@@ -56,6 +108,12 @@ class CodeAssessmentResult(BaseModel):
         return md
 
 
+class BatchAssessmentResult(CodeAssessmentResult):
+    """Assessment of several candidates at once; the verdict fields describe the candidate at `best_index`."""
+
+    best_index: int = Field(...)
+
+
 class ExecutionAssessmentHistoryItem(BaseModel):
     code: str
     execution_result: ExecutionResult
@@ -63,6 +121,12 @@ class ExecutionAssessmentHistoryItem(BaseModel):
     assessment: CodeAssessmentResult
 
     def generate_agent_message(self) -> AssistantMessage:
+        return self.agent_message
+
+    @cached_property
+    def agent_message(self) -> AssistantMessage:
+        # Built once: history items are never modified, and every later assessment resends them
+        # as the same, provider-cacheable prefix.
         return AssistantMessage(
             content=(
                 f"Plan:\n{self.plan}\n\n"
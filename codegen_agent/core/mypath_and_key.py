@@ -1,5 +1,6 @@
 # Determines the path for storing state and look for API keys.
 
+import functools
 import os
 from pathlib import Path
 from platformdirs import PlatformDirs
@@ -9,25 +10,25 @@ from dotenv import load_dotenv
 # -------------------------------------------------
 # PC specific path for standalone installation
 # -------------------------------------------------
+@functools.lru_cache(maxsize=None)
 def _state_path() -> Path:
     # Linux: ~/.local/state/codegen_agent/
     # Windows: %LOCALAPPDATA%\codegen_agent\State\
     # Devcontainer override: CODEGEN_AGENT_STATE=/workspaces/codegen_agent/state (or any path)
 
     # First, try to load dotenv from common locations to get potential CODEGEN_AGENT_STATE override
-    potential_dotenv_paths = [
+    # (and the API key). An explicit override is checked first; the scan stops at the first hit.
+    override_path = os.environ.get("CODEGEN_AGENT_DOTENV_PATH")
+    potential_dotenv_paths = (
+        Path(override_path) if override_path else None,
         Path.cwd() / ".env",  # Current working directory
         Path.home() / ".env",  # User home directory
         Path("/secrets") / "codegen_agent" / ".env",  # Common devcontainer path
-    ]
-
-    # Also check if explicit override is set
-    if override_path := os.environ.get("CODEGEN_AGENT_DOTENV_PATH"):
-        potential_dotenv_paths.insert(0, Path(override_path))
+    )
 
     # Load dotenv from first available location (without overriding existing env vars)
     for dotenv_path in potential_dotenv_paths:
-        if dotenv_path.is_file():
+        if dotenv_path is not None and dotenv_path.is_file():
             load_dotenv(dotenv_path, override=False)
             break
 
@@ -56,5 +57,6 @@ if not STATE_PATH.parent.exists():
         f"Parent of state directoy does not exist. Create it and set .env file following readme of codegen-agent: {STATE_PATH}"
     )
 
-for _p in (STATE_PATH, LOG_PATH, CACHE_PATH, CONTAINER_IO_PATH):
-    _p.mkdir(exist_ok=True)
+# parents=True creates STATE_PATH along with the first leaf.
+for _p in (LOG_PATH, CACHE_PATH, CONTAINER_IO_PATH):
+    _p.mkdir(parents=True, exist_ok=True)
@@ -1,4 +1,6 @@
-from typing import List
+import asyncio
+from datetime import date
+from typing import List, Optional, Tuple
 
 from .models import (
     CodeGenerationRequest,
@@ -7,10 +9,32 @@ from .models import (
     CodeAssessmentResult,
     ExecutionAssessmentHistoryItem,
 )
-from .llm_service import CodeGenerationService, AssessmentService
+from .llm_service import CodeGenerationService, AssessmentService, STDOUT_CLIP, STDERR_CLIP
 from .llm_client import FullLogChatClientCache
-from .execution.runner import execute as sandbox_execute
+from .cache import ResponseCache
+from .execution.runner import (
+    DEFAULT_IMAGE,
+    PreparedVariables,
+    execute_async as sandbox_execute,
+    prewarm as prewarm_sandbox,
+)
 from .workflow_ui import UI, ConsoleUI
+from .mylog import get_logger
+
+
+# Sampling temperatures for speculative candidates 1..k-1 are spread over this range;
+# candidate 0 keeps the client default so a single-candidate run is unchanged.
+SPECULATIVE_TEMPERATURE_RANGE = (0.5, 1.0)
+
+# (head, tail) characters of each attempt's output kept in history. History lives for the
+# whole workflow and is resent with every assessment, so multi-MB output is not kept there.
+HISTORY_STDOUT_CLIP = (12 * 1024, 4 * 1024)
+HISTORY_STDERR_CLIP = (4 * 1024, 12 * 1024)
+
+# Sampling temperature for the alternative drafted during retry turns.
+REGENERATION_TEMPERATURE = 0.7
+
+Trial = Tuple[str, ExecutionResult, CodeAssessmentResult]
 
 
 class AgentWorkflow:
@@ -23,56 +47,180 @@ class AgentWorkflow:
         *,
         ui: UI = ConsoleUI(),
         max_code_generation: int = 3,
+        speculative_k: int = 1,
+        two_stage_assessment: bool = False,
+        response_cache: Optional[ResponseCache] = None,
+        stdout_clip: Tuple[int, int] = STDOUT_CLIP,
+        stderr_clip: Tuple[int, int] = STDERR_CLIP,
+        image: str = DEFAULT_IMAGE,
+        skip_assessor_on_clean_first_run: bool = False,
+        speculative_regeneration: bool = False,
     ):
         self.request = request
-        self.codegen = CodeGenerationService(client)
-        self.assessor = AssessmentService(client)
+        self.codegen = CodeGenerationService(client, response_cache=response_cache)
+        self.assessor = AssessmentService(
+            client, two_stage=two_stage_assessment, stdout_clip=stdout_clip, stderr_clip=stderr_clip
+        )
         self.ui = ui
         self.max_code_generation = max_code_generation
+        # With speculative_k > 1 the first attempt runs k independent candidates concurrently.
+        self.speculative_k = speculative_k
         self.code_generation_count = 0
+        # Sandbox image; its runner container is started once and reused by every trial.
+        self.image = image
+        # Accept a first run that exits 0 with stdout and no stderr without asking the assessor.
+        self.skip_assessor_on_clean_first_run = skip_assessor_on_clean_first_run
+        # On retry turns, also draft a fresh candidate while the retry code executes (one extra LLM call per turn).
+        self.speculative_regeneration = speculative_regeneration
+        # One date for the whole workflow keeps prompts identical across its calls, even past midnight.
+        self._today = date.today().isoformat()
 
         self.current_code: str = ""
         self.code_result: CodeGenerationResult = CodeGenerationResult.empty_result()
         self.execution_result: ExecutionResult = ExecutionResult.empty_result()
         self.assessment: CodeAssessmentResult = CodeAssessmentResult.empty_assessment()
         self.history: List[ExecutionAssessmentHistoryItem] = []
+        self._prepared: Optional[PreparedVariables] = None
 
     async def run(self) -> str:
+        # Docker image check and container start-up overlap with the first LLM call.
+        prewarm_sandbox(self.image)
+
         # First generation
-        self.code_result = await self.codegen.generate_code(self.request)
-        self.current_code = self.code_result.code
+        speculative: Optional[Trial] = None
+        if self.speculative_k > 1:
+            speculative = await self._run_speculative_trials()
+            self.current_code = speculative[0]
+        else:
+            self.code_result = await self.codegen.generate_code(self.request, today=self._today)
+            self.current_code = self.code_result.code
         self.ui.show_generated_code(self.current_code, trial_number=self.code_generation_count + 1)
 
-        while True:
-            # Execute
-            self.execution_result = sandbox_execute(self.current_code, self.request.user_variables)
-            self.ui.show_results(self.execution_result, trial_number=self.code_generation_count + 1)
+        # Alternative code drafted during a retry turn (speculative_regeneration only).
+        spare: Optional[asyncio.Task[CodeGenerationResult]] = None
+        try:
+            while True:
+                orig_plan = self.assessment.plan
+                if speculative is not None:
+                    # The first attempt was already executed and assessed alongside the other candidates.
+                    _, self.execution_result, self.assessment = speculative
+                    speculative = None
+                    self.ui.show_results(self.execution_result, trial_number=self.code_generation_count + 1)
+                else:
+                    # Execute in a worker thread; meanwhile build the assessor's data context off the critical path.
+                    exec_task = asyncio.create_task(
+                        sandbox_execute(self.current_code, self._prepared_variables(), image=self.image)
+                    )
+                    if self.speculative_regeneration and self.code_generation_count > 0:
+                        # Retry turn: draft an independent alternative while the retry code runs. Passing
+                        # the attempts so far makes each turn's request (and its cache key) different.
+                        spare = asyncio.create_task(
+                            self.codegen.generate_code(
+                                self.request,
+                                temperature=REGENERATION_TEMPERATURE,
+                                today=self._today,
+                                failed_attempts=[item.code for item in self.history],
+                            )
+                        )
+                    self.assessor.prepare_data_description(self.request)
+                    self.execution_result = await exec_task
+                    self.ui.show_results(self.execution_result, trial_number=self.code_generation_count + 1)
 
-            # Assess and regenerate if needed
-            orig_plan = self.assessment.plan
-            self.assessment = await self.assessor.assess_code_output(
-                self.request, self.execution_result, self.current_code, self.history
-            )
-            self.ui.show_assessment(self.assessment)
-            self.code_generation_count += 1
-
-            self.history.append(
-                ExecutionAssessmentHistoryItem(
-                    plan=orig_plan,
-                    code=self.current_code,
-                    execution_result=self.execution_result,
-                    assessment=self.assessment,
+                    # Assess and regenerate if needed
+                    if self._is_clean_first_run():
+                        self.assessment = CodeAssessmentResult(
+                            analysis="First run exited cleanly with output; assessment skipped.",
+                            success=True,
+                            should_retry=False,
+                        )
+                    else:
+                        self.assessment = await self.assessor.assess_code_output(
+                            self.request, self.execution_result, self.current_code, self.history, today=self._today
+                        )
+                self.ui.show_assessment(self.assessment)
+                self.code_generation_count += 1
+
+                self.history.append(
+                    ExecutionAssessmentHistoryItem(
+                        plan=orig_plan,
+                        code=self.current_code,
+                        execution_result=self.execution_result.clipped(HISTORY_STDOUT_CLIP, HISTORY_STDERR_CLIP),
+                        assessment=self.assessment,
+                    )
                 )
-            )
 
-            if self.assessment.success:
-                self.ui.process_final_output(self.request, self.current_code)
-                self.ui.clean_code_section()
-                return self.current_code
+                if self.assessment.success:
+                    self.ui.process_final_output(self.request, self.current_code)
+                    self.ui.clean_code_section()
+                    return self.current_code
+
+                if self.code_generation_count >= self.max_code_generation:
+                    return self.current_code
+
+                if self.assessment.should_retry and self.assessment.code:
+                    self.current_code = self.assessment.code
+                    if spare is not None:
+                        spare.cancel()
+                        spare = None
+                    continue
+
+                if spare is not None:
+                    # No new code from the assessor: try the drafted alternative rather than re-running the same code.
+                    task, spare = spare, None
+                    try:
+                        draft = (await task).code
+                    except Exception as e:
+                        # The draft is only an optimisation: on failure, continue as without one.
+                        get_logger().warning(f"Alternative draft failed, continuing without it: {e!r}")
+                    else:
+                        if all(draft != item.code for item in self.history):
+                            self.current_code = draft
+        finally:
+            if spare is not None:
+                spare.cancel()
+
+    def _prepared_variables(self) -> PreparedVariables:
+        # Retries reuse one serialization of the variables; rebuilt only if the request's dict is replaced.
+        if self._prepared is None or self._prepared.variables is not self.request.user_variables:
+            self._prepared = PreparedVariables(self.request.user_variables)
+        return self._prepared
 
-            if self.code_generation_count >= self.max_code_generation:
-                return self.current_code
+    def _is_clean_first_run(self) -> bool:
+        result = self.execution_result
+        return (
+            self.skip_assessor_on_clean_first_run
+            and self.code_generation_count == 0
+            and result.returncode == 0
+            and not result.stderr
+            and bool(result.stdout.strip())
+        )
 
-            if self.assessment.should_retry and self.assessment.code:
-                self.current_code = self.assessment.code
-                continue
+    def _candidate_temperature(self, index: int) -> Optional[float]:
+        if index == 0:
+            return None
+        # Distinct temperatures give distinct cache keys, so cached runs still yield k different candidates.
+        low, high = SPECULATIVE_TEMPERATURE_RANGE
+        return low + (high - low) * index / (self.speculative_k - 1)
+
+    async def _run_speculative_trials(self) -> Trial:
+        """Generate and execute `speculative_k` candidates concurrently, then assess them in one call.
+
+        Returns the candidate the assessor ranked best, with its verdict.
+        """
+        results = await asyncio.gather(
+            *(
+                self.codegen.generate_code(
+                    self.request, temperature=self._candidate_temperature(i), today=self._today
+                )
+                for i in range(self.speculative_k)
+            )
+        )
+        codes = [result.code for result in results]
+        # Executions run in worker threads so candidates share the sandbox container concurrently.
+        execution_results = await asyncio.gather(
+            *(sandbox_execute(code, self._prepared_variables(), image=self.image) for code in codes)
+        )
+        assessment = await self.assessor.assess_batch(
+            self.request, list(execution_results), codes, self.history, today=self._today
+        )
+        return codes[assessment.best_index], execution_results[assessment.best_index], assessment
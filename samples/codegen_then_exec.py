@@ -10,7 +10,7 @@ import pandas as pd
 from codegen_agent.core.llm_client import create_client, LLMModels
 from codegen_agent.core.models import CodeGenerationRequest
 from codegen_agent.core.llm_service import CodeGenerationService
-from codegen_agent.core.execution.runner import execute
+from codegen_agent.core.execution.runner import execute_async, prewarm
 
 
 async def main() -> int:
@@ -31,10 +31,13 @@ async def main() -> int:
     )
     request = CodeGenerationRequest(request_text=req_text, user_variables=variables)
 
+    # Image check and container start-up run in the background during the LLM call.
+    prewarm()
     code = (await CodeGenerationService(client).generate_code(request)).code
     print("---- Generated code ----\n", code, "\n------------------------")
 
-    result = execute(code, variables)
+    # Off the event loop, like AgentWorkflow.
+    result = await execute_async(code, variables)
     print("\n---- Docker STDOUT ----\n", result.stdout)
     if result.stderr.strip():
         print("\n---- Docker STDERR ----\n", result.stderr)
@@ -22,9 +22,10 @@ except Exception:
 
 print("\nAttempting reading ...")
 try:
-    with open("/inputs/code.py", "r", encoding="utf-8") as f:
+    # The prelude's file name carries a content hash; it is the script this job runs.
+    with open(sys.argv[0], "r", encoding="utf-8") as f:
         txt = f.read()
-    print("OK: read /inputs/code.py")
+    print(f"OK: read {sys.argv[0]}")
     
 except Exception as e:
     print(f"NG: read failed: {e}")
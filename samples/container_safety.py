@@ -1,6 +1,7 @@
 # sample_container_safety.py
 # Direct Docker execution (no LLM). Tries destructive ops inside the guest container.
-# Confirms: /inputs is read-only, guest-only side effects, /outputs is writable.
+# Confirms: /inputs is read-only, guest-only side effects, /outputs is writable and private to
+# the run (its files, including /outputs/touch_ok.txt, end up in that run's outputs dir).
 # Requires: Docker running
 from codegen_agent.core.execution.runner import execute
 
@@ -22,9 +23,10 @@ except Exception:
 
 print("\nAttempting reading ...")
 try:
-    with open("/inputs/code.py", "r", encoding="utf-8") as f:
+    # The prelude's file name carries a content hash; it is the script this job runs.
+    with open(sys.argv[0], "r", encoding="utf-8") as f:
         txt = f.read()
-    print("OK: read /inputs/code.py")
+    print(f"OK: read {sys.argv[0]}")
     
 except Exception as e:
     print(f"NG: read failed: {e}")
@@ -41,6 +43,35 @@ import time
 
 import subprocess
 
+IMAGE = "codegen-agent-runner:py313"
+
+# All probes run under one bash parent, which timestamps each step, instead of one
+# Python-side fork/exec per probe. Like the runner, the probes `docker exec` into one warm
+# container (started before timing, with the runner's sandbox flags) rather than creating
+# a container each time.
+# Prints "t0 t1 t2 t3" in nanoseconds; exits 1 (Docker's errors on stderr) if any step fails,
+# since a failed probe returns almost at once and would otherwise look like a fast timing.
+PROFILE_SCRIPT = r"""
+cid=$(docker run -d --rm --network=none --read-only --tmpfs /tmp -v /tmp:/test_mount:ro "$1" sleep 3600)
+[ -n "$cid" ] || exit 1
+trap 'docker rm -f "$cid" >/dev/null 2>&1' EXIT
+t0=$(date +%s%N)
+docker exec "$cid" python -c "print('hello')" >/dev/null || exit 1
+t1=$(date +%s%N)
+docker exec "$cid" python -c "import os; print(len(os.listdir('/test_mount')))" >/dev/null || exit 1
+t2=$(date +%s%N)
+docker image inspect "$1" >/dev/null || exit 1
+t3=$(date +%s%N)
+echo "$t0 $t1 $t2 $t3"
+"""
+
+
+def _run_bytes(cmd):
+    """Run cmd with binary pipes and decode stdout/stderr once at the end; returns (returncode, stdout, stderr)."""
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return p.returncode, out.decode("utf-8", "replace"), err.decode("utf-8", "replace")
+
 
 def time_docker_operations():
     """Profile individual Docker operations"""
@@ -48,44 +79,20 @@ def time_docker_operations():
     # Test raw Docker performance
     print("=== Docker Performance Test ===")
 
-    # Test 1: Simple container run
-    start = time.time()
-    result = subprocess.run(
-        ["docker", "run", "--rm", "codegen-agent-runner:py313", "python", "-c", "print('hello')"],
-        capture_output=True,
-        text=True,
-    )
-    simple_time = time.time() - start
-    print(f"Simple container run: {simple_time:.3f}s")
-
-    # Test 2: Container with volume mounts (no execution)
-    start = time.time()
-    result = subprocess.run(
-        [
-            "docker",
-            "run",
-            "--rm",
-            "-v",
-            "/tmp:/test_mount:ro",
-            "codegen-agent-runner:py313",
-            "python",
-            "-c",
-            "print('with mount')",
-        ],
-        capture_output=True,
-        text=True,
-    )
-    mount_time = time.time() - start
-    print(f"Container with mount: {mount_time:.3f}s")
-
-    # Test 3: Check if image is actually cached
-    start = time.time()
-    result = subprocess.run(
-        ["docker", "image", "inspect", "codegen-agent-runner:py313"], capture_output=True, text=True
-    )
-    inspect_time = time.time() - start
-    print(f"Image inspection: {inspect_time:.3f}s")
+    returncode, out, err = _run_bytes(["bash", "-c", PROFILE_SCRIPT, "profile", IMAGE])
+    if returncode != 0:
+        raise RuntimeError(f"Docker profiling failed (exit {returncode}):\n{err.strip()}")
+    t0, t1, t2, t3 = (int(t) for t in out.split())
+
+    # Printed together once measuring is done, so output never interleaves with the probes.
+    results = {
+        "Simple container exec": (t1 - t0) / 1e9,
+        "Exec reading mount": (t2 - t1) / 1e9,
+        "Image inspection": (t3 - t2) / 1e9,
+    }
+    print("\n".join(f"{label}: {seconds:.3f}s" for label, seconds in results.items()))
 
+    simple_time, mount_time, inspect_time = results.values()
     return simple_time, mount_time, inspect_time
 
 
@@ -105,8 +112,8 @@ if __name__ == "__main__":
     print(f"Total time: {exec_end - start_time:.3f}s")
 
     print(f"\n=== Performance Analysis ===")
-    print(f"Simple Docker run: {simple_time:.3f}s")
-    print(f"Docker with mounts: {mount_time:.3f}s")
+    print(f"Simple Docker exec: {simple_time:.3f}s")
+    print(f"Docker exec reading mount: {mount_time:.3f}s")
     print(f"Full codegen execution: {exec_end - exec_start:.3f}s")
     print(f"Overhead ratio: {(exec_end - exec_start) / simple_time:.1f}x")
 
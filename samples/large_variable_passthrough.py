@@ -1,21 +1,37 @@
 # sample_large_variable_passthrough.py
 # Direct Docker execution (no LLM). Sends a ~50k-row DataFrame into the container and computes stats.
-# Validates pickle marshalling and performance of mounts.
+# Validates pickle marshalling: the frame's numpy blocks travel as protocol-5 out-of-band
+# buffers on the container's stdin (buffers of 64 MiB or more are mmapped from /inputs instead).
+# Set CODEGEN_AGENT_SHM_INPUTS=1 on Linux to keep those /inputs files in /dev/shm.
 
 from __future__ import annotations
+import functools
 import pandas as pd
 import numpy as np
 from codegen_agent.core.execution.runner import execute
+from codegen_agent.core.mypath_and_key import CACHE_PATH
 
 
+@functools.lru_cache(maxsize=None)
 def make_df(n: int = 50_000) -> pd.DataFrame:
+    # Built once per process, and kept as feather (if pyarrow is installed) for later runs.
+    cached = CACHE_PATH / f"sample_df_{n}.feather"
+    try:
+        return pd.read_feather(cached)
+    except (FileNotFoundError, ImportError):
+        pass
     rng = np.random.default_rng(42)
-    return pd.DataFrame(
+    df = pd.DataFrame(
         {
             "id": np.arange(n),
             "value": rng.normal(0, 1, size=n),
         }
     )
+    try:
+        df.to_feather(cached)
+    except ImportError:
+        pass
+    return df
 
 
 CODE = r"""
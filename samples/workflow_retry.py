@@ -6,7 +6,6 @@
 
 from __future__ import annotations
 import asyncio
-import json
 from types import SimpleNamespace
 
 from codegen_agent.core.models import (
@@ -39,7 +38,7 @@ class DeterministicLLM:
             self.codegen_calls += 1
             # Intentional "wrong" code: prints lowercase 'hello'
             payload = {"code": "print('hello')"}
-            return SimpleNamespace(content=json.dumps(payload))
+            return SimpleNamespace(content=None, parsed=payload)
 
         if json_output is CodeAssessmentResult:
             self.assess_calls += 1
@@ -61,10 +60,10 @@ class DeterministicLLM:
                     "plan": "",
                     "code": "",
                 }
-            return SimpleNamespace(content=json.dumps(payload))
+            return SimpleNamespace(content=None, parsed=payload)
 
         # Fallback (shouldn't happen here)
-        return SimpleNamespace(content=json.dumps({}))
+        return SimpleNamespace(content=None, parsed={})
 
 
 # ----------------------------